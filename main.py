@@ -1,54 +1,145 @@
 import alpaca_trade_api as alpaca
 import asyncio
+import math
+import numpy as np
 import pandas as pd
-import pytz
 import sys
+import time
 import logging
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as dtime, timedelta
+
 from alpaca_trade_api import Stream
 from alpaca_trade_api.common import URL
 from alpaca_trade_api.rest import TimeFrame
 
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # python < 3.9
+    from pytz import timezone as ZoneInfo
+
 logger = logging.getLogger()
 
 ALPACA_API_KEY = "<key_id>"
 ALPACA_SECRET_KEY = "<secret_key>"
 
+NY_TZ = ZoneInfo('America/New_York')
+# positions are liquidated and no new entries are made after this time
+_CUTOFF = dtime(15, 55)
+# length of a minute bar in nanoseconds
+_BAR_NS = 60 * 10**9
+# unfilled buy orders older than this are canceled
+_TWO_MIN = timedelta(minutes=2)
+# seconds between market clock checks
+_CLOCK_INTERVAL = 60
+# seconds the last streamed close is used in place of the last trade
+_LAST_PRICE_TTL = 5
+# attempts and max backoff in seconds when fetching the bootstrap bars
+_BARS_RETRIES = 8
+_BARS_MAX_BACKOFF = 30
+
+
+def _get_bars(api, symbols, start, end):
+    for attempt in range(_BARS_RETRIES):
+        # at inception this results sometimes in api errors. this will work
+        # around it. feel free to remove it once everything is stable
+        try:
+            return api.get_bars(symbols, TimeFrame.Minute, start, end,
+                                adjustment='raw').df
+        except Exception as e:
+            if attempt == _BARS_RETRIES - 1:
+                raise
+            delay = min(2 ** attempt, _BARS_MAX_BACKOFF)
+            logger.warning(
+                f'get_bars failed ({type(e).__name__}: {e}), '
+                f'retrying in {delay}s')
+            time.sleep(delay)
+
+
+class _RollingMean:
+    # O(1) per value port of the online algorithm behind pandas' (>= 1.5)
+    # rolling(window).mean(): Kahan-compensated adds and removes plus the
+    # shortcut for a window of identical values. A plain running sum drifts
+    # and flips buy signals on ties. Prices are positive and never NaN, so
+    # pandas' NaN and sign handling is left out.
+    def __init__(self, window):
+        self._window = window
+        self._values = deque()
+        self._sum = 0.0
+        self._add_comp = 0.0
+        self._remove_comp = 0.0
+        self._last = math.nan
+        self._run = 0
+        self.mean = math.nan
+
+    def push(self, val):
+        values = self._values
+        if len(values) == self._window:
+            y = -values.popleft() - self._remove_comp
+            t = self._sum + y
+            self._remove_comp = t - self._sum - y
+            self._sum = t
+        y = val - self._add_comp
+        t = self._sum + y
+        self._add_comp = t - self._sum - y
+        self._sum = t
+        self._run = self._run + 1 if val == self._last else 1
+        self._last = val
+        values.append(val)
+
+        n = len(values)
+        if n < self._window:
+            self.mean = math.nan
+        elif self._run >= n:
+            self.mean = val
+        else:
+            self.mean = self._sum / n
+
 
 class ScalpAlgo:
-    def __init__(self, api, symbol, lot):
+    def __init__(self, api, symbol, lot, bars=None, order=None,
+                 position=None):
         self._api = api
         self._symbol = symbol
         self._lot = lot
-        self._bars = []
+        self._last_price = None
+        self._last_price_at = 0.0
+        # cutoff bound for bar start times, set on the first bar of each day
+        self._last_bar_ns = 0
+        self._next_day_ns = 0
         self._l = logger.getChild(self._symbol)
 
-        now = pd.Timestamp.now(tz='America/New_York').floor('1min')
-        market_open = now.replace(hour=9, minute=30)
-        today = now.strftime('%Y-%m-%d')
-        tomorrow = (now + pd.Timedelta('1day')).strftime('%Y-%m-%d')
-        while 1:
-            # at inception this results sometimes in api errors. this will work
-            # around it. feel free to remove it once everything is stable
-            try:
-                data = api.get_bars(symbol, TimeFrame.Minute, today, tomorrow,
-                                    adjustment='raw').df
-                break
-            except:
-                # make sure we get bars
-                pass
-        bars = data[market_open:]
-        self._bars = bars
-
-        self._init_state()
-
-    def _init_state(self):
-        symbol = self._symbol
-        order = [o for o in self._api.list_orders() if o.symbol == symbol]
-        position = [p for p in self._api.list_positions()
-                    if p.symbol == symbol]
-        self._order = order[0] if len(order) > 0 else None
-        self._position = position[0] if len(position) > 0 else None
+        # the session so far is kept as preallocated rings of float64 closes
+        # and int64 bar start times (UTC epoch ns), so that each new bar is
+        # an O(1) write instead of a DataFrame copy
+        if bars is not None:
+            closes = bars['close'].to_numpy(dtype=np.float64)
+            # asi8 is in the index's own unit, which may be us rather than ns
+            ts_ns = bars.index.astype('datetime64[ns, UTC]').asi8
+        else:
+            closes = np.empty(0, dtype=np.float64)
+            ts_ns = np.empty(0, dtype=np.int64)
+        size = max(512, 2 * len(closes))
+        self._closes = np.empty(size, dtype=np.float64)
+        self._closes[:len(closes)] = closes
+        self._ts_ns = np.empty(size, dtype=np.int64)
+        self._ts_ns[:len(ts_ns)] = ts_ns
+        self._n = len(closes)
+        # 20-bar moving average at the latest and the previous bar, updated
+        # in O(1) per bar
+        self._mavg = _RollingMean(20)
+        self._prev_mavg = math.nan
+        for close in closes.tolist():
+            self._prev_mavg = self._mavg.mean
+            self._mavg.push(close)
+
+        self._init_state(order, position)
+
+    def _init_state(self, order, position):
+        self._order = order
+        self._position = position
         if self._position is not None:
             if self._order is None:
                 self._state = 'TO_SELL'
@@ -67,23 +158,38 @@ class ScalpAlgo:
                         f'state {self._state} mismatch order {self._order}')
 
     def _now(self):
-        return pd.Timestamp.now(tz='America/New_York')
+        return datetime.now(NY_TZ)
 
     def _outofmarket(self):
-        return self._now().time() >= pd.Timestamp('15:55').time()
+        return self._now().time() >= _CUTOFF
+
+    def _update_session(self, ts_ns):
+        day = pd.Timestamp(ts_ns, tz='UTC').tz_convert(
+            'America/New_York').normalize()
+        # a bar is out of market if it ends at or after the cutoff
+        cutoff = day.replace(hour=_CUTOFF.hour, minute=_CUTOFF.minute)
+        self._last_bar_ns = cutoff.value - _BAR_NS
+        self._next_day_ns = (day + pd.DateOffset(days=1)).value
+
+    def _get_last_price(self):
+        if (self._last_price is not None and
+                time.monotonic() - self._last_price_at < _LAST_PRICE_TTL):
+            return self._last_price
+        return self._api.get_last_trade(self._symbol).price
 
     def checkup(self, position):
         # self._l.info('periodic task')
 
         now = self._now()
         order = self._order
+        # both are tz-aware, so no conversion is needed to subtract them
         if (order is not None and
-            order.side == 'buy' and now -
-                order.submitted_at.tz_convert(tz='America/New_York') > pd.Timedelta('2 min')):
-            last_price = self._api.get_last_trade(self._symbol).price
+                order.side == 'buy' and
+                now - order.submitted_at > _TWO_MIN):
+            last_price = self._get_last_price()
             self._l.info(
-                f'canceling missed buy order {order.id} at {order.limit_price} '
-                f'(current price = {last_price})')
+                'canceling missed buy order %s at %s (current price = %s)',
+                order.id, order.limit_price, last_price)
             self._cancel_order()
 
         if self._position is not None and self._outofmarket():
@@ -94,32 +200,41 @@ class ScalpAlgo:
             self._api.cancel_order(self._order.id)
 
     def _calc_buy_signal(self):
-        mavg = self._bars.rolling(20).mean().close.values
-        closes = self._bars.close.values
+        closes = self._closes[:self._n]
+        mavg = (self._prev_mavg, self._mavg.mean)
         if closes[-2] < mavg[-2] and closes[-1] > mavg[-1]:
             self._l.info(
-                f'buy signal: closes[-2] {closes[-2]} < mavg[-2] {mavg[-2]} '
-                f'closes[-1] {closes[-1]} > mavg[-1] {mavg[-1]}')
+                'buy signal: closes[-2] %s < mavg[-2] %s '
+                'closes[-1] %s > mavg[-1] %s',
+                closes[-2], mavg[-2], closes[-1], mavg[-1])
             return True
         else:
-            self._l.info(
-                f'closes[-2:] = {closes[-2:]}, mavg[-2:] = {mavg[-2:]}')
+            self._l.info('closes[-2:] = %s, mavg[-2:] = %s',
+                         closes[-2:], mavg)
             return False
 
     def on_bar(self, bar):
-        self._bars = self._bars.append(pd.DataFrame({
-            'open': bar.open,
-            'high': bar.high,
-            'low': bar.low,
-            'close': bar.close,
-            'volume': bar.volume,
-        }, index=[pd.Timestamp(bar.timestamp, tz=pytz.UTC)]))
-
-        self._l.info(
-            f'received bar start: {pd.Timestamp(bar.timestamp)}, close: {bar.close}, len(bars): {len(self._bars)}')
-        if len(self._bars) < 21:
+        self._last_price = bar.close
+        self._last_price_at = time.monotonic()
+
+        ts_ns = bar.timestamp.value
+        if ts_ns >= self._next_day_ns:
+            self._update_session(ts_ns)
+
+        if self._n == len(self._closes):
+            self._closes = np.resize(self._closes, 2 * self._n)
+            self._ts_ns = np.resize(self._ts_ns, 2 * self._n)
+        self._prev_mavg = self._mavg.mean
+        self._mavg.push(bar.close)
+        self._closes[self._n] = bar.close
+        self._ts_ns[self._n] = ts_ns
+        self._n += 1
+
+        self._l.info('received bar start: %s, close: %s, len(bars): %d',
+                     bar.timestamp, bar.close, self._n)
+        if self._n < 21:
             return
-        if self._outofmarket():
+        if ts_ns >= self._last_bar_ns:
             return
         if self._state == 'TO_BUY':
             signal = self._calc_buy_signal()
@@ -160,8 +275,8 @@ class ScalpAlgo:
                 self._l.warn(f'unexpected state for {event}: {self._state}')
 
     def _submit_buy(self):
-        trade = self._api.get_last_trade(self._symbol)
-        amount = int(self._lot / trade.price)
+        price = self._get_last_price()
+        amount = int(self._lot / price)
         try:
             order = self._api.submit_order(
                 symbol=self._symbol,
@@ -169,7 +284,7 @@ class ScalpAlgo:
                 type='limit',
                 qty=amount,
                 time_in_force='day',
-                limit_price=trade.price,
+                limit_price=price,
             )
         except Exception as e:
             self._l.info(e)
@@ -190,9 +305,7 @@ class ScalpAlgo:
         if bailout:
             params['type'] = 'market'
         else:
-            current_price = float(
-                self._api.get_last_trade(
-                    self._symbol).price)
+            current_price = float(self._get_last_price())
             cost_basis = float(self._position.avg_entry_price)
             limit_price = max(cost_basis + 0.01, current_price)
             params.update(dict(
@@ -216,6 +329,13 @@ class ScalpAlgo:
 
 
 def main(args):
+    try:
+        # faster event loop for the stream, if available (not on Windows)
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     stream = Stream(ALPACA_API_KEY,
                     ALPACA_SECRET_KEY,
                     base_url=URL('https://paper-api.alpaca.markets'),
@@ -224,41 +344,75 @@ def main(args):
                     secret_key=ALPACA_SECRET_KEY,
                     base_url="https://paper-api.alpaca.markets")
 
-    fleet = {}
     symbols = args.symbols
+
+    # fetch today's bars, open orders and positions once for the whole fleet
+    now = pd.Timestamp.now(tz='America/New_York').floor('1min')
+    market_open = now.replace(hour=9, minute=30)
+    today = now.strftime('%Y-%m-%d')
+    tomorrow = (now + pd.Timedelta('1day')).strftime('%Y-%m-%d')
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        data = executor.submit(_get_bars, api, symbols, today, tomorrow)
+        open_orders = executor.submit(api.list_orders)
+        open_positions = executor.submit(api.list_positions)
+
+    data = data.result()
+    bars = {}
+    if not data.empty:
+        bars = {symbol: df[market_open:]
+                for symbol, df in data.groupby('symbol')}
+
+    orders = {}
+    for o in open_orders.result():
+        orders.setdefault(o.symbol, o)
+    positions = {p.symbol: p for p in open_positions.result()}
+
+    fleet = {}
     for symbol in symbols:
-        algo = ScalpAlgo(api, symbol, lot=args.lot)
+        algo = ScalpAlgo(api, symbol, lot=args.lot,
+                         bars=bars.get(symbol),
+                         order=orders.get(symbol),
+                         position=positions.get(symbol))
         fleet[symbol] = algo
 
+    # Stream only accepts coroutine handlers. these never await, so each bar
+    # runs to completion without suspending
     async def on_bars(data):
-        if data.symbol in fleet:
-            fleet[data.symbol].on_bar(data)
+        algo = fleet.get(data.symbol)
+        if algo is None:
+            return
+        algo.on_bar(data)
 
     for symbol in symbols:
         stream.subscribe_bars(on_bars, symbol)
 
     async def on_trade_updates(data):
         logger.info(f'trade_updates {data}')
-        symbol = data.order['symbol']
-        if symbol in fleet:
-            fleet[symbol].on_order_update(data.event, data.order)
+        algo = fleet.get(data.order['symbol'])
+        if algo is None:
+            return
+        algo.on_order_update(data.event, data.order)
 
     stream.subscribe_trade_updates(on_trade_updates)
 
-    async def periodic():
+    async def watch_clock():
         while True:
             if not api.get_clock().is_open:
                 logger.info('exit as market is not open')
                 sys.exit(0)
+            await asyncio.sleep(_CLOCK_INTERVAL)
+
+    async def periodic():
+        while True:
             await asyncio.sleep(30)
-            positions = api.list_positions()
+            by_sym = {p.symbol: p for p in api.list_positions()}
             for symbol, algo in fleet.items():
-                pos = [p for p in positions if p.symbol == symbol]
-                algo.checkup(pos[0] if len(pos) > 0 else None)
+                algo.checkup(by_sym.get(symbol))
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(asyncio.gather(
         stream._run_forever(),
+        watch_clock(),
         periodic(),
     ))
     loop.close()